@@ -1,37 +1,161 @@
 #!/bin/bash
 version=${1:-version_no_set}
+script_path=$(readlink -f "$0")
 # avoid PYLINTHOME is now '/home/goneri/.cache/pylint' but obsolescent '/home/goneri/.pylint.d' is found; you can safely remove the latter
 rm -r ~/.pylint.d ~/.cache/pylint
 # Use this script to commit an update of the vmare_rest collection
 source ~/.ansible/collections/ansible_collections/vmware/vmware_rest/tests/integration/targets/init.sh
 set -eux
 cd ~/.ansible/collections/ansible_collections/vmware/vmware_rest
-pip install pylint pycodestyle==2.7.0 pyvmomi requests voluptuous yamllint antsibull-changelog aiohttp
-tox -e refresh_modules -- --next-version ${version}
-mkdir -p logs
-(
+
+# Sanity results are cached per module, keyed on the content of the module,
+# of the other plugins, of meta/, of tests/sanity, of tests/config.yml, of
+# galaxy.yml, on the ansible-test version and on the Python interpreters of
+# the host. The modules that have not changed since the last successful run
+# are not checked again.
+sanity_cache_dir=${XDG_CACHE_HOME:-~/.cache}/vmware_rest_code_generator/sanity
+sanity_cache_key() {
+    echo ${sanity_common_key} $(sha256sum < "$1") | sha256sum | cut -d' ' -f1
+}
+
+# Every stage is recorded in a journal once it's done, with a key built from
+# its own inputs and from the key of the previous stage. A new run skips the
+# stages whose key is still in the journal, and resumes at the first one that
+# is stale or that has not been done yet. Changing the inputs of a stage,
+# e.g. the generator for refresh_modules, invalidates it and all the
+# following stages. The checks (sanity and linters) are not checkpointed,
+# they always run against the current state of the collection.
+checkpoint_dir=${XDG_CACHE_HOME:-~/.cache}/vmware_rest_code_generator/checkpoints
+checkpoint_journal=${checkpoint_dir}/journal
+stage_inputs() {
+    case $1 in
+    refresh_modules)
+        # The generator, its dependencies and the API specifications are
+        # installed in the tox environment
+        local venv=.tox/refresh_modules
+        if [ -x ${venv}/bin/python ]; then
+            ${venv}/bin/pip freeze
+            local generator_dir=$(${venv}/bin/python -c 'import gouttelette, os; print(os.path.dirname(gouttelette.__file__))' || true)
+            find ${generator_dir} ${venv}/share/vmware_rest_code_generator -type f -print0 2>/dev/null | sort -z | xargs -0 -r sha256sum
+        fi
+        # Without the generator, we cannot tell if the stage is up to date
+        if [ -z "${generator_dir:-}" ]; then
+            date +%s%N
+        fi
+        ;;
+    refresh_RETURN_block_*)
+        find tests/integration/targets/${1#refresh_RETURN_block_} -type f -print0 | sort -z | xargs -0 -r sha256sum
+        ;;
+    esac
+}
+stage_key() {
+    local stage=$1
+    shift
+    {
+        echo ${checkpoint_key}
+        echo ${stage} "$@"
+        stage_inputs ${stage}
+    } | sha256sum | cut -d' ' -f1
+}
+run_stage() {
+    local stage=$1
+    local key=$(stage_key "$@")
+    shift
+    if grep -qx "${stage} ${key}" ${checkpoint_journal}; then
+        echo "Skipping ${stage}, already done"
+        checkpoint_key=${key}
+        return
+    fi
+    "$@"
+    # Some inputs, like the tox environment, only exist once the stage has run
+    checkpoint_key=$(stage_key ${stage} "$@")
+    echo "${stage} ${checkpoint_key}" >> ${checkpoint_journal}
+}
+mkdir -p ${checkpoint_dir}
+touch ${checkpoint_journal}
+checkpoint_key=$(
+    {
+        echo ${version}
+        sha256sum < ${script_path}
+        sha256sum < tox.ini
+        git rev-parse HEAD
+    } | sha256sum | cut -d' ' -f1
+)
+
+reset_task_outputs() {
     rm -rf manual/source/vmware_rest_scenarios/task_outputs
     mkdir -p manual/source/vmware_rest_scenarios/task_outputs
-    for t in vcenter_vm_scenario1 vcenter_vm_customize vcenter_library_and_ovf_clone vcenter_vm_cloning vcenter_vm_clone_on_library appliance; do
-        cd ~/.ansible/collections/ansible_collections/vmware/vmware_rest/tests/integration/targets/${t}
+}
+
+refresh_RETURN_block() {
+    (
+        cd ~/.ansible/collections/ansible_collections/vmware/vmware_rest/tests/integration/targets/$1
         ./refresh_RETURN_block.sh
+    )
+}
+
+inject_RETURN() {
+    (
+        cd ~/.ansible/collections/ansible_collections/goneri/utils
+        ./scripts/inject_RETURN.py ~/.ansible/collections/ansible_collections/vmware/vmware_rest/manual/source/vmware_rest_scenarios/task_outputs/ ~/git_repos/ansible-collections/vmware_rest/ --config-file config/inject_RETURN.yaml
+    )
+}
+
+sanity() {
+    mkdir -p ${sanity_cache_dir}
+    # ansible-test runs the import and compile tests with every Python 3
+    # interpreter it finds on the host
+    sanity_common_key=$(
+        {
+            $(which ansible-test) --version
+            for python in $(compgen -c python3. | grep -E '^python3\.[0-9]+$' | sort -u); do
+                echo ${python} $(${python} --version 2>&1)
+            done
+            find plugins meta tests/sanity tests/config.yml galaxy.yml -type f ! -path 'plugins/modules/*' -print0 2>/dev/null | sort -z | xargs -0 sha256sum
+        } | sha256sum | cut -d' ' -f1
+    )
+    # Only the modules with a valid cache entry are skipped, the rest of the
+    # collection is always tested
+    local sanity_targets=()
+    local checked_modules=()
+    while IFS= read -r -d '' path; do
+        [ -e "${path}" ] || continue
+        case ${path} in
+        plugins/modules/*)
+            if [ -f ${sanity_cache_dir}/$(sanity_cache_key "${path}") ]; then
+                continue
+            fi
+            checked_modules+=("${path}")
+            ;;
+        esac
+        sanity_targets+=("${path}")
+    done < <(git ls-files -z --cached --others --exclude-standard)
+    $(which ansible-test) sanity -vvv "${sanity_targets[@]}"
+    for module in "${checked_modules[@]}"; do
+        touch ${sanity_cache_dir}/$(sanity_cache_key "${module}")
     done
-)
-(
-    cd ~/.ansible/collections/ansible_collections/goneri/utils
-    ./scripts/inject_RETURN.py ~/.ansible/collections/ansible_collections/vmware/vmware_rest/manual/source/vmware_rest_scenarios/task_outputs/ ~/git_repos/ansible-collections/vmware_rest/ --config-file config/inject_RETURN.yaml
-)
-tox -e black
-tox -e add_docs
-tox -e build_manual
+    rm -rf docs/docsite/rst/.doctrees
+    rm -rf tests/output/.tmp
+}
+
+run_stage pip_install pip install pylint pycodestyle==2.7.0 pyvmomi requests voluptuous yamllint antsibull-changelog aiohttp
+run_stage refresh_modules tox -e refresh_modules -- --next-version ${version}
+mkdir -p logs
+run_stage reset_task_outputs reset_task_outputs
+for t in vcenter_vm_scenario1 vcenter_vm_customize vcenter_library_and_ovf_clone vcenter_vm_cloning vcenter_vm_clone_on_library appliance; do
+    run_stage refresh_RETURN_block_${t} refresh_RETURN_block ${t}
+done
+run_stage inject_RETURN inject_RETURN
+run_stage black tox -e black
+run_stage add_docs tox -e add_docs
+run_stage build_manual tox -e build_manual
 
-find docs/docsite/rst/ -name '*.rst' -exec sed -i 's,’,",g' '{}' \;
+run_stage fix_quotes find docs/docsite/rst/ -name '*.rst' -exec sed -i 's,’,",g' '{}' \;
 
-$(which ansible-test) sanity -vvv
-rm -r docs/docsite/rst/.doctrees
-rm -rf tests/output/.tmp
+sanity
 tox -e linters
-tox -e antsibull-changelog -- release --verbose --version ${version}
+run_stage changelog tox -e antsibull-changelog -- release --verbose --version ${version}
 git add CHANGELOG.rst README.md dev.md plugins docs tests/sanity/ignore-*.txt
 git add changelogs
 git commit -S -F commit_message
+rm ${checkpoint_journal}